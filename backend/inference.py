@@ -68,7 +68,36 @@ class RoadDamageDetector:
             traceback.print_exc()
             return None
 
-    def _process_detections(self, result, img_size):
+    def predict_batch(self, images_data, device=None):
+        """Run one batched inference call over a list of image bytes.
+
+        Returns a list aligned with images_data holding the best detection
+        (or None) per image. Unlike predict(), nothing is written to disk and
+        per-box logging is suppressed so it can be used for bulk jobs.
+        """
+        if not self.model:
+            print("Model not loaded.")
+            return None
+
+        images = []
+        for image_data in images_data:
+            image = Image.open(io.BytesIO(image_data))
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            images.append(image)
+
+        if not images:
+            return []
+
+        # Same low confidence threshold as predict() so results are comparable
+        results = self.model(images, conf=0.01, verbose=False, device=device)
+
+        return [
+            self._process_detections(result, image.size, verbose=False)
+            for result, image in zip(results, images)
+        ]
+
+    def _process_detections(self, result, img_size, verbose=True):
         width, height = img_size
         best_detection = None
         max_score = 0.0
@@ -107,16 +136,18 @@ class RoadDamageDetector:
                 "class_name": class_name
             }
 
-            print(f"---> Found {class_name} ({damage_type}) - Conf: {score:.2f}")
+            if verbose:
+                print(f"---> Found {class_name} ({damage_type}) - Conf: {score:.2f}")
 
             if score > max_score:
                 max_score = score
                 best_detection = detection
         
-        if best_detection:
-            print(f"✅ Final Result: {best_detection['damageType']} ({best_detection['severity']}, {best_detection['confidence']:.2f})")
-        else:
-            print("❌ No confident detection found.")
+        if verbose:
+            if best_detection:
+                print(f"✅ Final Result: {best_detection['damageType']} ({best_detection['severity']}, {best_detection['confidence']:.2f})")
+            else:
+                print("❌ No confident detection found.")
 
         return best_detection
 
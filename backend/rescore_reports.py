@@ -0,0 +1,469 @@
+"""
+Bulk Re-scoring Tool for Historical Reports
+Re-runs the YOLO model over an exported backlog of report photos, writes the
+new results to Parquet part files as it goes, and diffs them against the
+ai_detection values stored at report time.
+
+Input is either a folder of images (report id = path inside the folder without
+extension, optional <id>.json sidecar holding the old ai_detection) or a JSONL/Parquet
+manifest exported from the reports table with at least `id` and `photo_uri`.
+
+Usage:
+    python rescore_reports.py <folder|manifest.jsonl|manifest.parquet> -o rescore_out
+    python rescore_reports.py reports.jsonl -o rescore_out --workers 4 --batch-size 16
+
+Re-running with the same output directory resumes where it stopped.
+"""
+
+import argparse
+import json
+import math
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+from pathlib import Path
+from urllib.parse import urlparse
+
+import pandas as pd
+
+BASE_DIR = Path(__file__).resolve().parent
+MODEL_PATH = BASE_DIR / "model" / "best.pt"
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.webp'}
+PART_PREFIX = "part-"
+DIFF_FILE = "diff.parquet"
+SUMMARY_FILE = "summary.json"
+
+# Confidence moves smaller than this are not reported as a change
+CONFIDENCE_TOLERANCE = 0.05
+FLOAT_COLUMNS = ['old_confidence', 'new_confidence']
+
+# Per-process detector, created once by the pool initializer
+_worker_detector = None
+_worker_device = None
+
+
+# =====================================================
+# INPUT LOADING
+# =====================================================
+
+def _parse_ai_detection(value, report_id):
+    """Normalise an ai_detection value from JSON/Parquet into a dict or None"""
+    if value is None:
+        return None
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if isinstance(value, str):
+        if not value.strip():
+            return None
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+        if value is None:
+            return None
+    if not isinstance(value, dict):
+        # Still re-score the report, just without an old result to diff against
+        print(f"⚠️  Ignoring unreadable stored ai_detection for report {report_id}: {value!r:.80}")
+        return None
+    detection = dict(value)
+
+    # The app stores {damageType: 'other', confidence: 0, ...} when nothing was found
+    if detection.get('confidence') in (0, '0'):
+        return None
+    return detection
+
+
+def _resolve_media_path(photo_uri, media_root):
+    """Map a photo_uri from the export to a local file path"""
+    parsed = urlparse(photo_uri)
+    if parsed.scheme in ('http', 'https'):
+        # Storage URLs are mirrored into the media root by file name
+        return media_root / Path(parsed.path).name
+    if parsed.scheme == 'file':
+        return Path(parsed.path)
+
+    path = Path(photo_uri)
+    return path if path.is_absolute() else media_root / path
+
+
+def load_records_from_folder(folder):
+    """One record per image file; <id>.json next to it is the old ai_detection"""
+    records = []
+    seen = {}
+    for path in sorted(folder.rglob('*')):
+        if path.suffix.lower() not in IMAGE_EXTENSIONS:
+            continue
+
+        # Relative path keeps ids unique across subfolders
+        relative = path.relative_to(folder)
+        report_id = relative.with_suffix('').as_posix()
+        if report_id in seen:
+            raise ValueError(f"Duplicate report id '{report_id}': {seen[report_id]} and {path}")
+        seen[report_id] = path
+
+        old_detection = None
+        sidecar = path.with_suffix('.json')
+        if sidecar.exists():
+            with open(sidecar, 'r', encoding='utf-8') as f:
+                old_detection = _parse_ai_detection(f.read(), report_id)
+
+        records.append({
+            'id': report_id,
+            'photo_uri': relative.as_posix(),
+            'media_path': str(path),
+            'old_ai_detection': old_detection,
+        })
+    return records
+
+
+def load_records_from_manifest(manifest, media_root):
+    """Read a JSONL or Parquet export of the reports table"""
+    if manifest.suffix.lower() == '.parquet':
+        rows = pd.read_parquet(manifest).to_dict(orient='records')
+    else:
+        rows = []
+        with open(manifest, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    rows.append(json.loads(line))
+
+    records = []
+    seen = set()
+    for row in rows:
+        if not row.get('id') or not row.get('photo_uri'):
+            print(f"⚠️  Skipping manifest row without id/photo_uri: {row.get('id')}")
+            continue
+        report_id = str(row['id'])
+        if report_id in seen:
+            raise ValueError(f"Duplicate report id '{report_id}' in {manifest}")
+        seen.add(report_id)
+
+        records.append({
+            'id': report_id,
+            'photo_uri': row['photo_uri'],
+            'media_path': str(_resolve_media_path(row['photo_uri'], media_root)),
+            'old_ai_detection': _parse_ai_detection(row.get('ai_detection'), report_id),
+        })
+    return records
+
+
+def load_records(source, media_root=None):
+    source = Path(source)
+    if source.is_dir():
+        return load_records_from_folder(source)
+    if not source.exists():
+        raise FileNotFoundError(f"Input not found: {source}")
+    return load_records_from_manifest(source, Path(media_root) if media_root else source.parent)
+
+
+# =====================================================
+# OUTPUT / RESUME
+# =====================================================
+
+def _part_files(output_dir):
+    return sorted(output_dir.glob(f"{PART_PREFIX}*.parquet"))
+
+
+def load_results(output_dir):
+    """All rows written so far, keeping the latest attempt per report id"""
+    parts = _part_files(output_dir)
+    if not parts:
+        return pd.DataFrame()
+    results = pd.concat([pd.read_parquet(p) for p in parts], ignore_index=True)
+    return results.drop_duplicates(subset='id', keep='last').reset_index(drop=True)
+
+
+def completed_ids(output_dir):
+    """Report ids that already have a successful result (errors are retried)"""
+    results = load_results(output_dir)
+    if results.empty:
+        return set()
+    return set(results.loc[results['error'].isna(), 'id'])
+
+
+def write_part(output_dir, index, rows):
+    """Write one batch of results atomically so an interrupted run never leaves half a file"""
+    final_path = output_dir / f"{PART_PREFIX}{index:05d}.parquet"
+    tmp_path = final_path.with_suffix('.parquet.tmp')
+    df = pd.DataFrame(rows)
+    # Keep a stable schema even when a whole part has no confidences
+    df[FLOAT_COLUMNS] = df[FLOAT_COLUMNS].astype('float64')
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, final_path)
+    return final_path
+
+
+def _next_part_index(output_dir):
+    parts = _part_files(output_dir)
+    if not parts:
+        return 0
+    return int(parts[-1].stem[len(PART_PREFIX):]) + 1
+
+
+def compact_parts(output_dir):
+    """Merge all part files into one so later resumes and diffs read a single file"""
+    parts = _part_files(output_dir)
+    if len(parts) <= 1:
+        return
+    results = load_results(output_dir)
+    # Written under a newer index first, so a crash mid-cleanup still resolves to the merged rows
+    write_part(output_dir, _next_part_index(output_dir), results.to_dict(orient='records'))
+    for part in parts:
+        part.unlink()
+    print(f"🗜️  Merged {len(parts)} part files into one")
+
+
+# =====================================================
+# DIFF
+# =====================================================
+
+def _to_confidence(value):
+    """Stored confidences come from client JSON; anything non-numeric is treated as unknown"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def compare_detections(old, new):
+    """Classify how the new detection differs from the stored one"""
+    if not old and not new:
+        return 'unchanged'
+    if not old:
+        return 'added'
+    if not new:
+        return 'removed'
+    if old.get('damageType') != new.get('damageType'):
+        return 'type_changed'
+    if old.get('severity') != new.get('severity'):
+        return 'severity_changed'
+    old_conf = _to_confidence(old.get('confidence'))
+    if old_conf is None or abs(float(new['confidence']) - old_conf) > CONFIDENCE_TOLERANCE:
+        return 'confidence_changed'
+    return 'unchanged'
+
+
+def build_row(record, new_detection, model_path, error=None):
+    old = record['old_ai_detection']
+    new = None
+    if new_detection:
+        # Same shape the app and video processor store in reports.ai_detection
+        new = {
+            'damageType': new_detection['damageType'],
+            'confidence': float(new_detection['confidence']),
+            'severity': new_detection['severity'],
+            'boundingBox': new_detection['boundingBox'],
+        }
+
+    return {
+        'id': record['id'],
+        'photo_uri': record['photo_uri'],
+        'old_damage_type': old.get('damageType') if old else None,
+        'old_severity': old.get('severity') if old else None,
+        'old_confidence': _to_confidence(old.get('confidence')) if old else None,
+        'new_damage_type': new['damageType'] if new else None,
+        'new_severity': new['severity'] if new else None,
+        'new_confidence': new['confidence'] if new else None,
+        'old_ai_detection': json.dumps(old) if old else None,
+        'new_ai_detection': json.dumps(new) if new else None,
+        'change': 'error' if error else compare_detections(old, new),
+        'error': error,
+        'model_path': model_path,
+        'scored_at': pd.Timestamp.now(tz='UTC'),
+    }
+
+
+def write_diff(output_dir):
+    """Write changed rows to diff.parquet and return a summary dict"""
+    results = load_results(output_dir)
+    if results.empty:
+        return {'total': 0, 'changes': {}}
+
+    diff = results[results['change'] != 'unchanged']
+    diff.to_parquet(output_dir / DIFF_FILE, index=False)
+
+    confidence_delta = (results['new_confidence'] - results['old_confidence']).dropna()
+    summary = {
+        'total': int(len(results)),
+        'changes': {k: int(v) for k, v in results['change'].value_counts().items()},
+        'mean_confidence_delta': float(confidence_delta.mean()) if not confidence_delta.empty else None,
+        'damage_type_transitions': {
+            f"{old} -> {new}": int(count)
+            for (old, new), count in results[results['change'] == 'type_changed']
+            .groupby(['old_damage_type', 'new_damage_type']).size().items()
+        },
+    }
+    with open(output_dir / SUMMARY_FILE, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+# =====================================================
+# WORKERS
+# =====================================================
+
+def _init_worker(model_path, device, threads):
+    """Load one model per worker process"""
+    global _worker_detector, _worker_device
+    import torch
+    from inference import RoadDamageDetector
+
+    if threads:
+        torch.set_num_threads(threads)
+    _worker_detector = RoadDamageDetector(model_path)
+    _worker_device = device
+
+
+def _score_batch(records, model_path):
+    """Score a batch of records in the worker; never raises"""
+    rows = [None] * len(records)
+    images, positions = [], []
+
+    for i, record in enumerate(records):
+        try:
+            with open(record['media_path'], 'rb') as f:
+                images.append(f.read())
+            positions.append(i)
+        except OSError as e:
+            rows[i] = build_row(record, None, model_path, error=f"read failed: {e}")
+
+    if _worker_detector is None or _worker_detector.model is None:
+        for i in positions:
+            rows[i] = build_row(records[i], None, model_path, error="model not loaded")
+        return rows
+
+    try:
+        detections = _worker_detector.predict_batch(images, device=_worker_device)
+    except Exception:
+        detections = None
+
+    if detections is not None:
+        for i, detection in zip(positions, detections):
+            rows[i] = build_row(records[i], detection, model_path)
+        return rows
+
+    # One bad image fails the whole batch; retry individually to isolate it
+    for i, image in zip(positions, images):
+        try:
+            detection = _worker_detector.predict_batch([image], device=_worker_device)[0]
+        except Exception as e:
+            rows[i] = build_row(records[i], None, model_path, error=f"inference failed: {e}")
+            continue
+        rows[i] = build_row(records[i], detection, model_path)
+
+    return rows
+
+
+# =====================================================
+# MAIN
+# =====================================================
+
+def rescore(source, output_dir, model_path, workers, batch_size, device=None, media_root=None,
+            flush_rows=None):
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    records = load_records(source, media_root)
+    done = completed_ids(output_dir)
+    pending = [r for r in records if r['id'] not in done]
+
+    print(f"📋 Reports in input: {len(records)}")
+    print(f"✅ Already scored: {len(records) - len(pending)}")
+    print(f"⏳ To score: {len(pending)}")
+
+    if pending:
+        batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+        # Split CPU cores between workers so they don't oversubscribe each other
+        threads = max(1, (os.cpu_count() or 1) // workers) if device in (None, 'cpu') else None
+        part_index = _next_part_index(output_dir)
+        # Default to one part per batch so a hard kill loses at most the batches in flight
+        flush_rows = flush_rows or batch_size
+        buffer = []
+        scored = 0
+        errors = 0
+        start = time.perf_counter()
+
+        # spawn keeps torch state out of forked workers and matches Windows behaviour
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(str(model_path), device, threads),
+        ) as pool:
+            futures = [pool.submit(_score_batch, batch, str(model_path)) for batch in batches]
+            try:
+                for future in as_completed(futures):
+                    rows = future.result()
+                    buffer.extend(rows)
+                    if len(buffer) >= flush_rows:
+                        write_part(output_dir, part_index, buffer)
+                        part_index += 1
+                        buffer = []
+
+                    scored += len(rows)
+                    errors += sum(1 for row in rows if row['error'])
+                    elapsed = time.perf_counter() - start
+                    print(f"  {scored}/{len(pending)} scored "
+                          f"({scored / elapsed:.1f} img/s, {errors} errors)")
+            except KeyboardInterrupt:
+                print("\n⛔ Interrupted - finished batches are saved, re-run to resume.")
+                pool.shutdown(wait=False, cancel_futures=True)
+                raise
+            finally:
+                if buffer:
+                    write_part(output_dir, part_index, buffer)
+
+        elapsed = time.perf_counter() - start
+        print(f"\n⏱️  Scored {scored} images in {elapsed:.1f}s "
+              f"({scored / elapsed:.1f} img/s with {workers} worker(s), batch size {batch_size})")
+
+    compact_parts(output_dir)
+    summary = write_diff(output_dir)
+    print(f"\n📊 Diff vs stored ai_detection ({summary['total']} reports):")
+    for change, count in sorted(summary['changes'].items()):
+        print(f"   {change}: {count}")
+    print(f"💾 Results: {output_dir}")
+    print(f"💾 Diff: {output_dir / DIFF_FILE}")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-score historical reports with the current model")
+    parser.add_argument('source', help="Folder of images, or a .jsonl/.parquet reports export")
+    parser.add_argument('-o', '--output', default='rescore_output', help="Output directory (reused to resume)")
+    parser.add_argument('--model', default=str(MODEL_PATH), help="Path to the YOLO weights")
+    parser.add_argument('--media-root', help="Folder holding the exported photos (default: manifest folder)")
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="Worker processes, each with its own model")
+    parser.add_argument('--batch-size', type=int, default=16, help="Images per inference call")
+    parser.add_argument('--device', help="Inference device, e.g. cpu, 0, cuda:0")
+    parser.add_argument('--flush-rows', type=int,
+                        help="Rows buffered before a Parquet part file is written (default: one batch). "
+                             "Larger values mean fewer files, but up to this many scored rows are "
+                             "re-scored after a hard kill")
+    args = parser.parse_args()
+
+    if not Path(args.model).exists():
+        print(f"❌ ERROR: Model file not found at {args.model}")
+        sys.exit(1)
+    if args.workers < 1 or args.batch_size < 1 or (args.flush_rows is not None and args.flush_rows < 1):
+        print("❌ ERROR: --workers, --batch-size and --flush-rows must be at least 1")
+        sys.exit(1)
+
+    try:
+        rescore(args.source, args.output, args.model, args.workers, args.batch_size,
+                device=args.device, media_root=args.media_root, flush_rows=args.flush_rows)
+    except KeyboardInterrupt:
+        sys.exit(130)
+    except Exception as e:
+        print(f"❌ Re-scoring failed: {e}")
+        traceback.print_exc()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()